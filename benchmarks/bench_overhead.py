@@ -0,0 +1,77 @@
+"""Measure the per-test overhead of the rerun plugin.
+
+Generates a module with N trivial passing tests and runs it with the plugin
+disabled (no --reruns) and enabled (--reruns=1). Every run happens in a fresh
+interpreter, the two configurations are interleaved and a warm-up round of
+each is discarded, so neither side profits from imports, caches or a warmed
+up disk. The CPU time of the pytest session itself is taken inside the child
+process (wall-clock time is too sensitive to other load on the machine) and
+the best of the rounds is kept for each configuration. The difference
+divided by N is the cost the plugin adds to every test that doesn't need
+a rerun.
+
+    $ python benchmarks/bench_overhead.py [N] [ROUNDS]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytest
+
+
+def make_suite(directory, count):
+    with open(os.path.join(directory, "test_bench.py"), "w") as f:
+        for i in range(count):
+            f.write("def test_%d():\n    pass\n\n" % i)
+
+
+def run_child(directory, args):
+    """Run pytest in a child process, return the CPU time of its session."""
+    output = subprocess.check_output(
+        [sys.executable, __file__, "--child", directory] + args,
+        stderr=subprocess.DEVNULL)
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def child(directory, args):
+    start = time.process_time()
+    with open(os.devnull, "w") as devnull:
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            pytest.main(["-q", "-p", "no:cacheprovider", directory] + args)
+        finally:
+            sys.stdout = stdout
+    print(time.process_time() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    directory = tempfile.mkdtemp()
+    make_suite(directory, count)
+
+    configurations = [("without plugin", []), ("with --reruns", ["--reruns=1"])]
+    # Warm-up round, not measured
+    for _, args in configurations:
+        run_child(directory, args)
+    best = {}
+    for _ in range(rounds):
+        for name, args in configurations:
+            elapsed = run_child(directory, args)
+            best[name] = min(best.get(name, elapsed), elapsed)
+
+    without, with_reruns = best["without plugin"], best["with --reruns"]
+    print("pytest %s, %d tests, best of %d interleaved rounds" % (pytest.__version__, count, rounds))
+    print("without plugin: %.3fs CPU" % without)
+    print("with --reruns:  %.3fs CPU" % with_reruns)
+    print("overhead:       %.1f us per test" % ((with_reruns - without) / count * 1e6))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--child":
+        child(sys.argv[2], sys.argv[3:])
+    else:
+        main()
@@ -0,0 +1,123 @@
+"""Live rerun counters served in the Prometheus text format.
+
+The endpoint is either a TCP address ("[host:]port", host defaults to
+127.0.0.1) or a Unix socket ("unix:/path/to/socket"); any GET request
+returns the current values, e.g.
+
+    $ curl http://127.0.0.1:9100/metrics
+    $ curl --unix-socket /tmp/reruns.sock http://localhost/metrics
+"""
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import os
+import socketserver
+import stat
+import threading
+
+# name, type, help
+METRICS = [
+    ("rerunfailures_attempts_total", "counter", "Test attempts run, reruns included"),
+    ("rerunfailures_reruns_passed_total", "counter", "Rerun attempts that passed"),
+    ("rerunfailures_reruns_failed_total", "counter", "Rerun attempts that failed or aborted"),
+    ("rerunfailures_reruns_scheduled_total", "counter", "Failures qualified for a rerun"),
+    ("rerunfailures_reruns_skipped_total", "counter", "Failures not qualified for a rerun"),
+    ("rerunfailures_run_seconds_total", "counter", "Time spent on first attempts"),
+    ("rerunfailures_rerun_seconds_total", "counter", "Time spent on reruns"),
+    ("rerunfailures_rerun_budget_remaining_seconds", "gauge", "Rerun time left before --rerun_time_threshold"),
+    ("rerunfailures_deferred_reruns", "gauge", "Reruns waiting for the end of the suite (--rerun_after)"),
+]
+
+
+class RerunMetrics(object):
+    def __init__(self, rerun_time_threshold):
+        self.lock = threading.Lock()
+        self.values = OrderedDict((name, 0) for name, _, _ in METRICS)
+        self.values["rerunfailures_rerun_budget_remaining_seconds"] = rerun_time_threshold
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.values[name] += value
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+        lines = []
+        for name, metric_type, help_text in METRICS:
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            lines.append("%s %s" % (name, round(values[name], 3)))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't mix request logs into the test output
+        pass
+
+
+class TCPMetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class UnixMetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = socketserver.UnixStreamServer.get_request(self)
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ("", 0)
+
+
+def parse_address(address):
+    """Return ("unix", path) or ("tcp", (host, port)), ValueError if malformed."""
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if not path:
+            raise ValueError("missing socket path in %r" % address)
+        return "unix", path
+    host, _, port = address.rpartition(":")
+    if not port.isdigit() or int(port) > 65535:
+        raise ValueError("expected [host:]port or unix:/path, got %r" % address)
+    return "tcp", (host or "127.0.0.1", int(port))
+
+
+def start_server(address, metrics):
+    """Serve ``metrics`` on ``address`` from a daemon thread, return the server.
+
+    Raises ValueError if a Unix socket path is taken by something else than a
+    socket, OSError if the address can't be bound.
+    """
+    kind, target = parse_address(address)
+    if kind == "unix":
+        # A socket left over from an earlier run is replaced, anything else is kept
+        if os.path.lexists(target):
+            if not stat.S_ISSOCK(os.lstat(target).st_mode):
+                raise ValueError("%s exists and is not a socket" % target)
+            os.remove(target)
+        server = UnixMetricsServer(target, MetricsHandler)
+    else:
+        server = TCPMetricsServer(target, MetricsHandler)
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever, name="rerunfailures-metrics")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+    if isinstance(server, UnixMetricsServer) and os.path.exists(server.server_address):
+        os.remove(server.server_address)
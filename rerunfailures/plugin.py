@@ -1,87 +1,228 @@
-from _pytest.terminal import TerminalReporter
-import py, pytest
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import sys
+import types
+import pytest
 
 from _pytest.runner import runtestprotocol
 
+from rerunfailures.metrics import RerunMetrics, parse_address, start_server, stop_server
+from rerunfailures.profiler import StackSampler, profile_filename, write_collapsed
+
 # Add command line options
 def pytest_addoption(parser):
     group = parser.getgroup("rerunfailures", "re-run failing tests to eliminate flaky failures")
-    group._addoption('--reruns',
-                     action="store",
-                     dest="reruns",
-                     type="int",
-                     default=0,
-                     help="number of times to re-run failed tests. defaults to 0.")
-
-    group._addoption('--timelimit',
-                     action="store",
-                     dest="timelimit",
-                     type="int",
-                     default=0,
-                     help="if test failed after timelimit, it will be not rerunned. Defaults to 7200 (2hrs)")
-    group._addoption('--rerun_time_threshold',
-                     action="store",
-                     dest="rerun_time_threshold",
-                     type="int",
-                     default=7200,
-                     help="Allowed  time in seconds to spend on tests reruning. If total rerun time is  "
-                          "more then threshold, then rerun is skipped")
-    group._addoption('--skip_tests',
-                     action="store",
-                     dest="skip_tests",
-                     default="",
-                     help="Comma-separated list of tests that should be explicitly skipped. If test is parametrized")
-    group._addoption('--rerun_after',
-                     action="count",
-                     dest="rerun_after",
-                     default=0,
-                     help="Rerun tests after whole test suite finishes")
-
-
-@pytest.mark.trylast
+    group.addoption('--reruns',
+                    action="store",
+                    dest="reruns",
+                    type=int,
+                    default=0,
+                    help="number of times to re-run failed tests. defaults to 0.")
+
+    group.addoption('--timelimit',
+                    action="store",
+                    dest="timelimit",
+                    type=int,
+                    default=7200,
+                    help="if test failed after timelimit, it will be not rerunned. Defaults to 7200 (2hrs)")
+    group.addoption('--rerun_time_threshold',
+                    action="store",
+                    dest="rerun_time_threshold",
+                    type=int,
+                    default=7200,
+                    help="Allowed  time in seconds to spend on tests reruning. If total rerun time is  "
+                         "more then threshold, then rerun is skipped")
+    group.addoption('--skip_tests',
+                    action="store",
+                    dest="skip_tests",
+                    default="",
+                    help="Comma-separated list of tests that should be explicitly skipped. If test is parametrized")
+    group.addoption('--rerun_after',
+                    action="count",
+                    dest="rerun_after",
+                    default=0,
+                    help="Rerun tests after whole test suite finishes")
+    group.addoption('--rerun_log',
+                    action="store",
+                    dest="rerun_log",
+                    default="",
+                    help="Path to a file where every test attempt is logged as a JSON line, "
+                         "written incrementally during the session. With xdist every worker "
+                         "writes its own PATH.<worker id> file")
+    group.addoption('--flaky_first',
+                    action="store_true",
+                    dest="flaky_first",
+                    default=False,
+                    help="Run tests that needed reruns in previous sessions first, the most "
+                         "expensive (flake probability * duration) ones at the very beginning")
+    group.addoption('--triage_cache',
+                    action="store",
+                    dest="triage_cache",
+                    type=int,
+                    default=0,
+                    help="Remember up to N deterministic failures (keyed by test, code hash and failure "
+                         "message) in the pytest cache and don't rerun them again for unchanged code. "
+                         "Defaults to 0 (disabled)")
+    group.addoption('--rerun_metrics',
+                    action="store",
+                    dest="rerun_metrics",
+                    default="",
+                    help="Serve live rerun counters in Prometheus text format on [host:]port "
+                         "or unix:/path/to/socket")
+    group.addoption('--rerun_profile',
+                    action="store",
+                    dest="rerun_profile",
+                    default="",
+                    help="Directory to write sampled collapsed stacks of rerun attempts and of failed "
+                         "first attempts of tests known to be flaky")
+    group.addoption('--rerun_profile_interval',
+                    action="store",
+                    dest="rerun_profile_interval",
+                    type=float,
+                    default=0.005,
+                    help="Sampling interval of --rerun_profile in seconds. Defaults to 0.005")
+
+
+@pytest.hookimpl(trylast=True)
 def pytest_configure(config):
-    if hasattr(config, 'slaveinput'):
-        return  # xdist slave, we are already active on the master
+    if hasattr(config, 'workerinput'):
+        return  # xdist worker, we are already active on the controller
     if config.option.reruns:
-        # Get the standard terminal reporter plugin...
-        standard_reporter = config.pluginmanager.getplugin('terminalreporter')
-        reruninfo_reporter = RerunInfoTerminalReporter(standard_reporter)
-
-        # ...and replace it with our own rerun info reporter.
-        config.pluginmanager.unregister(standard_reporter)
-        config.pluginmanager.register(reruninfo_reporter, 'terminalreporter')
+        check_metrics_option(config)
+        if config.option.rerun_after and is_xdist_controller(config):
+            # Workers only run the items sent by the controller, appended ones would be lost
+            raise pytest.UsageError("--rerun_after is not supported with pytest-xdist (-n)")
+        # Results handed over by xdist workers, written to the cache by the controller
+        config.rerun_worker_outputs = []
+        # Add rerun summaries to the standard terminal reporter
+        if config.pluginmanager.has_plugin('terminalreporter'):
+            config.pluginmanager.register(RerunInfoReporter(config), 'rerunreporter')
     else:
         # If no rerun option, completely unload plugin
-        rerun_plugin = config.pluginmanager.getplugin('rerunfailures')
-        config.pluginmanager.unregister(rerun_plugin)
+        config.pluginmanager.unregister(sys.modules[__name__])
 
 
 # making sure the options make sense
 # should run before / at the begining of pytest_cmdline_main
 def check_options(config):
     # TODO add assertations for other options
-    val = config.getvalue
-    if not val("collectonly"):
+    if not config.getoption("collectonly"):
         if config.option.reruns != 0:
             if config.option.usepdb:  # a core option
                 raise pytest.UsageError("--reruns incompatible with --pdb")
 
 
+def check_metrics_option(config):
+    address = config.option.rerun_metrics
+    if not address:
+        return
+    if is_xdist_controller(config):
+        # Every worker would serve its own counters on the same address
+        raise pytest.UsageError("--rerun_metrics is not supported with pytest-xdist (-n)")
+    try:
+        parse_address(address)
+    except ValueError as e:
+        raise pytest.UsageError("--rerun_metrics: %s" % e)
+
+
+def get_worker_id(config):
+    workerinput = getattr(config, "workerinput", None)
+    if workerinput is None:
+        return None
+    return workerinput["workerid"]
+
+
+# xdist controller, the tests are run (and rerun) on the workers
+def is_xdist_controller(config):
+    return not hasattr(config, "workerinput") and getattr(config.option, "dist", "no") != "no"
+
+
+# Each xdist worker writes its own log, suffixed with the worker id
+def get_rerun_log_path(config):
+    path = config.option.rerun_log
+    if not path or is_xdist_controller(config):
+        return None
+    worker_id = get_worker_id(config)
+    if worker_id is not None:
+        return "%s.%s" % (path, worker_id)
+    return path
+
+
 def pytest_sessionstart(session):
     # Initialising rerun time profiler
     session.ordinary_tests_durations = 0
     session.rerun_tests_durations = 0
+    # Failure messages seen so far, mapped to their id in the rerun log
+    session.failure_messages = {}
+    session.rerun_log = None
+    rerun_log_path = get_rerun_log_path(session.config)
+    if rerun_log_path:
+        session.rerun_log = open(rerun_log_path, 'w')
+    load_triage_cache(session)
+    session.rerun_metrics = None
+    session.rerun_metrics_server = None
+    if session.config.option.rerun_metrics:
+        session.rerun_metrics = RerunMetrics(session.config.option.rerun_time_threshold)
+        try:
+            session.rerun_metrics_server = start_server(session.config.option.rerun_metrics,
+                                                        session.rerun_metrics)
+        except (OSError, ValueError) as e:
+            raise pytest.UsageError("--rerun_metrics: %s" % e)
 
 
 # This mark means hook will be called before default hook
 # (for reporting to use reduced number of tests, without re-started ones)
-@pytest.mark.tryfirst
+@pytest.hookimpl(tryfirst=True)
 def pytest_sessionfinish(session, exitstatus):
     # Removing duplicate items, leaving only the very last instance of each test
     items = session.items
-    for item in items:
-        while items.count(item) > 1:
-            items.remove(item)
+    seen = set()
+    last_instances = []
+    for item in reversed(items):
+        if item not in seen:
+            seen.add(item)
+            last_instances.append(item)
+    items[:] = reversed(last_instances)
+    if session.rerun_log is not None:
+        session.rerun_log.close()
+        session.rerun_log = None
+    if get_worker_id(session.config) is not None:
+        # Only the controller writes the cache, workers would overwrite each other
+        session.config.workeroutput["rerunfailures"] = {
+            "flaky_runs": get_flaky_runs(items),
+            "triage_keys": session.triage_used_keys,
+        }
+    else:
+        if is_xdist_controller(session.config):
+            flaky_runs = merge_worker_outputs(session)
+        else:
+            flaky_runs = get_flaky_runs(items)
+        store_flaky_stats(session.config, flaky_runs)
+        store_triage_cache(session)
+    if session.rerun_metrics_server is not None:
+        stop_server(session.rerun_metrics_server)
+        session.rerun_metrics_server = None
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node, error):
+    output = getattr(node, "workeroutput", {}).get("rerunfailures")
+    if output is not None:
+        node.config.rerun_worker_outputs.append(output)
+
+
+def merge_worker_outputs(session):
+    flaky_runs = {}
+    for output in session.config.rerun_worker_outputs:
+        for key in output["triage_keys"]:
+            use_triage_key(session, key)
+        # Every worker collects all tests, but runs only some of them
+        for nodeid, run in output["flaky_runs"].items():
+            if run is not None or nodeid not in flaky_runs:
+                flaky_runs[nodeid] = run
+    return flaky_runs
+
 
 # Init all elements to have attempt field
 def pytest_collection_modifyitems(session, config, items):
@@ -89,8 +230,84 @@ def pytest_collection_modifyitems(session, config, items):
     the items in-place."""
     for item in items:
         item.attempt = 1
+        item.attempts = []
+    session.flaky_stats = load_flaky_stats(config)
+    if config.option.flaky_first:
+        order_flaky_first(session.flaky_stats, items)
+
+
+FLAKY_STATS_KEY = "rerunfailures/flaky_stats"
+
 
+# Move tests with the highest expected rerun cost to the front,
+# so their reruns happen early in the session
+def order_flaky_first(stats, items):
+    if not stats:
+        return
 
+    def rerun_cost(item):
+        runs, flaky_runs, duration = stats.get(item.nodeid, (0, 0, 0))
+        if not runs:
+            return 0
+        return float(flaky_runs) / runs * duration
+
+    # sort is stable, so tests that never flaked keep their collection order
+    items.sort(key=rerun_cost, reverse=True)
+
+
+def load_flaky_stats(config):
+    cache = getattr(config, "cache", None)
+    if cache is None:
+        return {}
+    return cache.get(FLAKY_STATS_KEY, {})
+
+
+def is_known_flaky(item):
+    _, flaky_runs, _ = getattr(item.session, "flaky_stats", {}).get(item.nodeid, (0, 0, 0))
+    return flaky_runs > 0
+
+
+# Map collected test ids to (flaky, first-attempt duration) for the tests run in
+# this session, and to None for the ones that weren't run
+def get_flaky_runs(items):
+    flaky_runs = {}
+    for item in items:
+        attempts = getattr(item, "attempts", None)
+        if not attempts:
+            flaky_runs.setdefault(item.nodeid, None)
+            continue
+        _, first_duration, _ = attempts[0]
+        last_outcome, _, _ = attempts[-1]
+        # Tests failing on every attempt are broken, not flaky
+        flaky = len(attempts) > 1 and last_outcome == "passed"
+        flaky_runs[item.nodeid] = (flaky, round(first_duration, 3))
+    return flaky_runs
+
+
+# Update per-test run count, count of runs which passed only on a rerun, and the last first-attempt duration
+def store_flaky_stats(config, flaky_runs):
+    # Stats are only needed by --flaky_first and --rerun_profile
+    if not (config.option.flaky_first or config.option.rerun_profile):
+        return
+    cache = getattr(config, "cache", None)
+    if cache is None:
+        return
+    previous_stats = cache.get(FLAKY_STATS_KEY, {})
+    # Tests which weren't collected in this session (e.g. deleted ones) are dropped
+    stats = {}
+    for nodeid, run in flaky_runs.items():
+        entry = previous_stats.get(nodeid)
+        if run is None:
+            if entry is not None:
+                stats[nodeid] = entry
+            continue
+        runs, flaky_count, _ = entry or (0, 0, 0)
+        flaky, first_duration = run
+        stats[nodeid] = (runs + 1, flaky_count + flaky, first_duration)
+    cache.set(FLAKY_STATS_KEY, stats)
+
+
+@pytest.hookimpl(tryfirst=True)
 def pytest_runtest_protocol(item, nextitem):
     """
     Note: when teardown fails, two reports are generated for the case, one for the test
@@ -102,57 +319,119 @@ def pytest_runtest_protocol(item, nextitem):
     item.ihook.pytest_runtest_logstart(
         nodeid=item.nodeid, location=item.location,
     )
+    if item.attempt > 1 and item.config.option.rerun_after:
+        count_metric(item.session, "rerunfailures_deferred_reruns", -1)
+    # Immediate reruns are run right here, so they work on xdist workers too
+    # (which only run the items the controller sends them)
+    qualify_rerun = run_attempt(item, nextitem)
+    while qualify_rerun and not item.config.option.rerun_after:
+        qualify_rerun = run_attempt(item, nextitem)
+
+    # Final results carry the summary of all attempts (for junitxml / report-log)
+    if not qualify_rerun:
+        annotate_attempts(item, item.reports)
+        remember_deterministic_failure(item)
+
+    # Update report attempt field (to report these values)
+    for report in item.reports:
+        # Only update for "call" (not setup and teardown)
+        if report.when in ("call"):
+            report.attempt = item.attempt
+        # If test is scheduled for rerun, results are not final, so we don't generate report
+        if not qualify_rerun:
+            item.ihook.pytest_runtest_logreport(report=report)
+        # For debug puproses
+        verbose_output(item)
+    if not qualify_rerun:
+        item.ihook.pytest_runtest_logfinish(nodeid=item.nodeid, location=item.location)
+
+    # pytest_runtest_protocol returns True
+    return True
+
+
+# Run the item once, return True if it has to be run again
+def run_attempt(item, nextitem):
     # If rerun after is enabled, we should skip already scheduled reruns (that was scheduled before threshold reached)
     if  item.attempt > 1 and item.config.option.rerun_after and item.session.rerun_tests_durations > item.config.option.rerun_time_threshold:
         reason = "total rerun threshold reached"
-        print "rerun skipped, reason: " + reason + " testcase: " + item.nodeid
+        print("rerun skipped, reason: " + reason + " testcase: " + item.nodeid)
         # Do not touch item report status here
         # Just decrease attempt count (was increased while scheduling test to rerun
         item.attempt -= 1
+        executed = False
     else:
         # Do test execution and assign report status
-        item.reports = runtestprotocol(item, nextitem=nextitem, log=False)
-    # Update cumulative test durations
-    update_test_durations(item.reports, item.session, item.attempt)
+        sampler = None
+        if should_profile(item):
+            sampler = StackSampler(item.config.option.rerun_profile_interval)
+            sampler.start()
+        try:
+            item.reports = runtestprotocol(item, nextitem=nextitem, log=False)
+        finally:
+            # Don't leave the sampler thread running if the session is interrupted
+            stacks = sampler.stop() if sampler is not None else None
+        if sampler is not None:
+            write_profile(item, stacks)
+        executed = True
+        # Update cumulative test durations
+        update_test_durations(item.reports, item.session, item.attempt)
     # Get test status (aware of rerun)
     test_succeed, test_aborted, status_message = report_test_status(item, item.reports)
+    if executed:
+        record_attempt(item, item.reports, test_succeed, test_aborted)
+        if item.attempt > 1:
+            count_metric(item.session, "rerunfailures_reruns_passed_total" if test_succeed
+                         else "rerunfailures_reruns_failed_total")
 
-    if item.config.option.verbose:
-        print item.nodeid, " attepmt " + str(item.attempt)
+    if item.config.option.verbose > 0:
+        print(item.nodeid, " attepmt " + str(item.attempt))
 
     qualify_rerun = False
-    if test_succeed or test_aborted:
+    # Nothing to rerun if nothing failed (e.g. skipped or xfailed tests)
+    if test_succeed or test_aborted or not any(report.failed for report in item.reports):
         pass
     else:
         # Check rerun conditions
         qualify, reason = qualify_for_rerun(item, item.reports)
         if not (qualify):
-            print "rerun skipped, reason: " + reason + " testcase: " + item.nodeid
+            count_metric(item.session, "rerunfailures_reruns_skipped_total")
+            print("rerun skipped, reason: " + reason + " testcase: " + item.nodeid)
         else:
+            count_metric(item.session, "rerunfailures_reruns_scheduled_total")
             # Schedule item to be executed somewhere in future
             schedule_item_rerun(item, item.config)
             qualify_rerun = True
+    return qualify_rerun
 
-    # Update report attempt field (to report these values)
-    for report in item.reports:
-        # Only update for "call" (not setup and teardown)
-        if report.when in ("call"):
-            report.attempt = item.attempt
-        # If test is scheduled for rerun, results are not final, so we don't generate report
-        if not qualify_rerun:
-            item.ihook.pytest_runtest_logreport(report=report)
-        # For debug puproses
-        verbose_output(item)
 
-    # pytest_runtest_protocol returns True
-    return True
+# Profile reruns, and first attempts of tests which needed reruns before
+def should_profile(item):
+    if not item.config.option.rerun_profile:
+        return False
+    return item.attempt > 1 or is_known_flaky(item)
+
+
+def write_profile(item, stacks):
+    test_succeed, _, _ = report_test_status(item, item.reports)
+    # A passing first attempt has nothing to compare with
+    if item.attempt == 1 and test_succeed:
+        return
+    directory = item.config.option.rerun_profile
+    path = os.path.join(directory, profile_filename(item.nodeid, item.attempt))
+    # Profiling must never break the test run
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        write_collapsed(path, stacks)
+    except OSError as e:
+        item.warn(pytest.PytestWarning("could not write rerun profile %s: %s" % (path, e)))
 
 
 def verbose_output(item):
-    if item.config.option.verbose:
+    if item.config.option.verbose > 0:
         # For debug purposes
-        print "\n    time spent on runs: ", item.session.ordinary_tests_durations
-        print "    time spent on reruns: \n", item.session.rerun_tests_durations
+        print("\n    time spent on runs: ", item.session.ordinary_tests_durations)
+        print("    time spent on reruns: \n", item.session.rerun_tests_durations)
 
 # Get test execution results
 def report_test_status(item, reports):
@@ -180,13 +459,13 @@ def report_test_status(item, reports):
     return test_succeed, test_aborted, "".join(status_message)
 
 
-# Depending on option, schedule rerun just after this item, or at the run end
+# Depending on option, rerun right away (in pytest_runtest_protocol), or at the run end
 def schedule_item_rerun(item, config):
     item.attempt += 1
+    # Otherwise pytest_runtest_protocol runs it again right away
     if config.option.rerun_after:
         item.session.items.append(item)
-    else:
-        item.session.items.insert(item.session.items.index(item) + 1, item)
+        count_metric(item.session, "rerunfailures_deferred_reruns")
 
 # Decide if test is qulified for rerun
 def qualify_for_rerun(item, reports):
@@ -200,10 +479,14 @@ def qualify_for_rerun(item, reports):
                 return False, "".join(reason)
 
     # Check if there attempts for rerun left
-    if item.attempt > item.config.option.reruns + 1:
+    if item.attempt > item.config.option.reruns:
         reason.append("failure rerun attempt limit reached ")
         return False, "".join(reason)
 
+    # If the very same failure was already reproduced on every rerun of this code, skip
+    if item.attempt == 1 and is_known_deterministic_failure(item, reports):
+        reason.append("known deterministic failure for unchanged code")
+        return False, "".join(reason)
 
     # If test duration exceeds time limit, skip
     if get_test_duration(reports) > item.config.option.timelimit:
@@ -219,128 +502,291 @@ def qualify_for_rerun(item, reports):
     return True, "".join(reason)
 
 
+# Remember attempt results and append them to the rerun log, if enabled
+def record_attempt(item, reports, test_succeed, test_aborted):
+    if test_succeed:
+        outcome = "passed"
+    elif test_aborted:
+        outcome = "aborted"
+    else:
+        outcome = "failed"
+    message = get_failure_message(reports)
+    message_id = None
+    if message is not None:
+        messages = item.session.failure_messages
+        message_id = messages.get(message)
+        if message_id is None:
+            # Each distinct failure message is logged only once, attempts refer to it by id
+            message_id = messages[message] = len(messages)
+            write_rerun_log(item.session, {"message_id": message_id, "message": message})
+    duration = get_test_duration(reports)
+    item.attempts.append((outcome, duration, message))
+    write_rerun_log(item.session, {"nodeid": item.nodeid, "attempt": item.attempt,
+                                   "outcome": outcome, "duration": round(duration, 3),
+                                   "message_id": message_id})
+
+
+def write_rerun_log(session, record):
+    if session.rerun_log is not None:
+        session.rerun_log.write(json.dumps(record, separators=(',', ':')) + "\n")
+        session.rerun_log.flush()
+
+
+# Add compact per-attempt properties to the last report of a rerun test
+def annotate_attempts(item, reports):
+    # Tests that were run only once don't get any extra properties
+    if len(item.attempts) < 2:
+        return
+    properties = [
+        ("rerun_attempts", str(len(item.attempts))),
+        ("rerun_outcomes", ",".join(outcome for outcome, _, _ in item.attempts)),
+        ("rerun_durations", ",".join("%.3f" % duration for _, duration, _ in item.attempts)),
+    ]
+    seen = set()
+    for _, _, message in item.attempts:
+        if message is not None and message not in seen:
+            seen.add(message)
+            properties.append(("rerun_failure", message))
+    # junitxml collects user properties from the teardown report
+    report = reports[-1]
+    if not hasattr(report, "user_properties"):
+        report.user_properties = []
+    report.user_properties.extend(properties)
+
+
+# First failure message of the reports (setup, call, teardown) or None if all passed
+def get_failure_message(reports):
+    for report in reports:
+        if report.failed:
+            reprcrash = getattr(report.longrepr, "reprcrash", None)
+            if reprcrash is not None:
+                return reprcrash.message
+            return str(report.longrepr).strip().splitlines()[-1]
+    return None
+
+
+TRIAGE_CACHE_KEY = "rerunfailures/triage"
+
+
+def load_triage_cache(session):
+    # Least recently used keys first
+    session.triage_cache = None
+    # Keys in the order they were used, for the xdist controller to replay
+    session.triage_used_keys = []
+    session.code_hashes = {}
+    session.module_files = {}
+    cache = getattr(session.config, "cache", None)
+    if session.config.option.triage_cache and cache is not None:
+        session.triage_cache = OrderedDict((key, True) for key in cache.get(TRIAGE_CACHE_KEY, []))
+
+
+def store_triage_cache(session):
+    if session.triage_cache is not None:
+        session.config.cache.set(TRIAGE_CACHE_KEY, list(session.triage_cache))
+
+
+def triage_key(item, message):
+    return "%s:%s:%s" % (item.nodeid, get_code_hash(item),
+                         hashlib.sha1(message.encode("utf-8")).hexdigest())
+
+
+def is_known_deterministic_failure(item, reports):
+    triage_cache = item.session.triage_cache
+    if not triage_cache:
+        return False
+    message = get_failure_message(reports)
+    if message is None:
+        return False
+    key = triage_key(item, message)
+    if key not in triage_cache:
+        return False
+    use_triage_key(item.session, key)
+    return True
+
+
+# Remember test which failed with the same message on every attempt
+def remember_deterministic_failure(item):
+    triage_cache = item.session.triage_cache
+    if triage_cache is None or len(item.attempts) < 2:
+        return
+    messages = set(message for outcome, _, message in item.attempts if outcome == "failed")
+    if len(messages) != 1 or any(outcome != "failed" for outcome, _, _ in item.attempts):
+        return
+    use_triage_key(item.session, triage_key(item, messages.pop()))
+
+
+# Add the key, or mark it as recently used, and evict the least recently used ones
+def use_triage_key(session, key):
+    triage_cache = session.triage_cache
+    if triage_cache is None:
+        return
+    triage_cache.pop(key, None)
+    triage_cache[key] = True
+    session.triage_used_keys.append(key)
+    while len(triage_cache) > session.config.option.triage_cache:
+        triage_cache.popitem(last=False)
+
+
+# Hash of the test file, of the project modules (from inside rootdir) it imports
+# directly or through other project modules, and of the conftest.py files (fixtures) on its path
+def get_code_hash(item):
+    files = set(get_conftest_files(item))
+    module = getattr(item, "module", None)
+    if module is None:
+        files.add(str(item.path))
+    else:
+        files.update(get_module_files(item.session, module, str(item.config.rootpath) + os.sep))
+    return hash_files(item.session, sorted(files))
+
+
+def get_module_files(session, module, rootdir):
+    files = session.module_files.get(module.__name__)
+    if files is not None:
+        return files
+    files = set()
+    seen = set([module.__name__])
+    pending = [module]
+    while pending:
+        current = pending.pop()
+        files.add(current.__file__)
+        for value in vars(current).values():
+            if not isinstance(value, types.ModuleType):
+                value = sys.modules.get(getattr(value, "__module__", None) or "")
+            filename = getattr(value, "__file__", None)
+            # Installed packages (e.g. a virtualenv inside rootdir) are not project code
+            if (filename and filename.startswith(rootdir) and "site-packages" not in filename
+                    and value.__name__ not in seen):
+                seen.add(value.__name__)
+                pending.append(value)
+    session.module_files[module.__name__] = files
+    return files
+
+
+def get_conftest_files(item):
+    rootpath = item.config.rootpath
+    directory = item.path.parent
+    conftests = []
+    while True:
+        conftest = directory / "conftest.py"
+        if conftest.is_file():
+            conftests.append(str(conftest))
+        if directory == rootpath or directory == directory.parent or rootpath not in directory.parents:
+            break
+        directory = directory.parent
+    return conftests
+
+
+def hash_files(session, filenames):
+    digest = hashlib.sha1()
+    for filename in filenames:
+        if filename.endswith((".pyc", ".pyo")):
+            filename = filename[:-1]
+        # Every file is read only once per session
+        file_hash = session.code_hashes.get(filename)
+        if file_hash is None:
+            try:
+                with open(filename, "rb") as f:
+                    file_hash = hashlib.sha1(f.read()).hexdigest()
+            except OSError:
+                file_hash = ""
+            session.code_hashes[filename] = file_hash
+        digest.update(file_hash.encode("ascii"))
+    return digest.hexdigest()
+
+
 def update_test_durations(reports, session, attempt):
     current_test_duration = get_test_duration(reports)
     # If this is not a first try, add duration to reruns time, else to runs time
     if attempt > 1:
         session.rerun_tests_durations += current_test_duration
+        count_metric(session, "rerunfailures_rerun_seconds_total", current_test_duration)
     else:
         session.ordinary_tests_durations += current_test_duration
+        count_metric(session, "rerunfailures_run_seconds_total", current_test_duration)
+    count_metric(session, "rerunfailures_attempts_total")
+    if session.rerun_metrics is not None:
+        session.rerun_metrics.set("rerunfailures_rerun_budget_remaining_seconds",
+                                  session.config.option.rerun_time_threshold - session.rerun_tests_durations)
+
+
+def count_metric(session, name, value=1):
+    if session.rerun_metrics is not None:
+        session.rerun_metrics.inc(name, value)
 
 
 def get_test_duration(reports):
-    current_test_duration = 0
     # reports is a list of stuff, executed for an item (setup, call, teardown)
     # We count cumulative duration of it
-    for j in range(len(reports)):
-        current_test_duration += reports[j].duration
-    return current_test_duration
+    return sum(report.duration for report in reports)
 
 
 def pytest_report_teststatus(report):
     """ adapted from
     https://bitbucket.org/hpk42/pytest/src/a5e7a5fa3c7e/_pytest/skipping.py#cl-170
     """
-    if report.when in ("call"):
-        if report.attempt > 1:
+    if report.when == "call":
+        if getattr(report, "attempt", 1) > 1:
+            # Counted as a regular failure, so the summary and its colour show it
             if report.outcome == "failed":
-                return "rerun failed", "e", "FAILED_ON_RERUN"
+                return "failed", "F", "FAILED_ON_RERUN"
             if report.outcome == "passed":
                 return "rerun passed", "R", "PASSED_ON_RERUN"
             if report.outcome == "aborted":
                 return "rerun aborted", "A", "ABORTED_ON_RERUN"
 
-# Adopted from https://github.com/jpvanhal/pytest-instafail/blob/master/pytest_instafail.py
-# With slight changes
-class RerunInfoTerminalReporter(TerminalReporter):
-    def __init__(self, reporter):
-        TerminalReporter.__init__(self, reporter.config)
-        self._tw = reporter._tw
-
-    def summary_stats(self):
-        session_duration = py.std.time.time() - self._sessionstarttime
-
-        keys = "failed passed skipped deselected xfailed xpassed".split()
-
-        for key in self.stats.keys():
-            if key not in keys:
-                keys.append(key)
-        parts = []
-        for key in keys:
-            if key:  # setup/teardown reports have an empty key, ignore them
-                val = self.stats.get(key, None)
-                if val:
-                    parts.append("%d %s" % (len(val), key))
-        line = ", ".join(parts)
-        msg = "%s in %.2f seconds" % (line, session_duration)
-
-        markup = {'bold': True}
-        # Modification here: if all tests were failed on rerun, make terminal red
-        if 'failed' in self.stats or 'error' in self.stats or 'rerun failed':
-            markup = {'red': True, 'bold': True}
-        else:
-            markup = {'green': True, 'bold': True}
-
-        if self.verbosity >= 0:
-            self.write_sep("=", msg, **markup)
-        if self.verbosity == -1:
-            self.write_line(msg, **markup)
-
-    def pytest_sessionfinish(self, exitstatus, __multicall__):
-        __multicall__.execute()
-        self._tw.line("")
-        if exitstatus in (0, 1, 2, 4):
-            self.summary_errors()
-            self.summary_failures()
-            # Added summary for reruns
-            self.summary_rerun_failed()
-            self.summary_rerun_aborted()
-            self.summary_rerun_passed()
-            self.config.hook.pytest_terminal_summary(terminalreporter=self)
-        if exitstatus == 2:
-            self._report_keyboardinterrupt()
-            del self._keyboardinterrupt_memo
-        self.summary_deselected()
-        self.summary_stats()
-
-    def summary_rerun_passed(self):
-        if self.config.option.tbstyle != "no":
-            reports = self.getreports('rerun passed')
-            if not reports:
-                return
-            self.write_sep("=", "PASSED ON RERUN")
-            for rep in reports:
-                line = rep.nodeid + " duration: " + "%.2f" % rep.duration
-                if hasattr(rep, "attempt"):
-                    line = line + " attempt: " + str(rep.attempt)
-                self.write_line(line)
-
-    def summary_rerun_failed(self):
-        if self.config.option.tbstyle != "no":
-            reports = self.getreports('rerun failed')
-            if not reports:
-                return
-            self.write_sep("=", "FAILED ON RERUN")
-            for rep in reports:
-                if self.config.option.tbstyle == "line":
-                    line = self._getcrashline(rep)
-                    self.write_line(line)
-                else:
-                    msg = self._getfailureheadline(rep)
-                    self.write_sep("_", msg)
-                    self._outrep_summary(rep)
-
-    def summary_rerun_aborted(self):
-        if self.config.option.tbstyle != "no":
-            reports = self.getreports('rerun aborted')
-            if not reports:
-                return
-            self.write_sep("=", "ABORTED ON RERUN")
-            for rep in reports:
-                if self.config.option.tbstyle == "line":
-                    line = self._getcrashline(rep)
-                    self.write_line(line)
-                else:
-                    msg = self._getfailureheadline(rep)
-                    self.write_sep("_", msg)
-                    self._outrep_summary(rep)
\ No newline at end of file
+# Adds rerun sections to the summary of the standard terminal reporter
+class RerunInfoReporter(object):
+    def __init__(self, config):
+        self.config = config
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if self.config.option.tbstyle == "no":
+            return
+        self.summary_rerun_failed(terminalreporter)
+        self.summary_rerun_aborted(terminalreporter)
+        self.summary_rerun_passed(terminalreporter)
+        if "R" in terminalreporter.reportchars:
+            self.short_rerun_summary(terminalreporter)
+
+    # Requested with -r R, shown right before the short test summary info
+    def short_rerun_summary(self, terminalreporter):
+        reports = terminalreporter.getreports('rerun passed')
+        if not reports:
+            return
+        terminalreporter.write_sep("=", "rerun test summary info")
+        for rep in reports:
+            terminalreporter.write_line("RERUN " + rep.nodeid)
+
+    def summary_rerun_passed(self, terminalreporter):
+        self._summary_rerun_attempts(terminalreporter, terminalreporter.getreports('rerun passed'),
+                                     "PASSED ON RERUN")
+
+    def summary_rerun_failed(self, terminalreporter):
+        # Their tracebacks are already in the FAILURES section
+        reports = [rep for rep in terminalreporter.getreports('failed')
+                   if getattr(rep, "attempt", 1) > 1]
+        self._summary_rerun_attempts(terminalreporter, reports, "FAILED ON RERUN")
+
+    def summary_rerun_aborted(self, terminalreporter):
+        reports = terminalreporter.getreports('rerun aborted')
+        if not reports:
+            return
+        terminalreporter.write_sep("=", "ABORTED ON RERUN")
+        for rep in reports:
+            if self.config.option.tbstyle == "line":
+                line = terminalreporter._getcrashline(rep)
+                terminalreporter.write_line(line)
+            else:
+                msg = terminalreporter._getfailureheadline(rep)
+                terminalreporter.write_sep("_", msg)
+                terminalreporter._outrep_summary(rep)
+
+    def _summary_rerun_attempts(self, terminalreporter, reports, title):
+        if not reports:
+            return
+        terminalreporter.write_sep("=", title)
+        for rep in reports:
+            line = rep.nodeid + " duration: " + "%.2f" % rep.duration
+            if hasattr(rep, "attempt"):
+                line = line + " attempt: " + str(rep.attempt)
+            terminalreporter.write_line(line)
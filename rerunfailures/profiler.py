@@ -0,0 +1,67 @@
+"""Sampling profiler for single test attempts.
+
+A daemon thread looks at the stack of the test thread every ``interval``
+seconds and counts identical stacks. The result is written in the collapsed
+stack format ("outer;inner;innermost count" per line) understood by
+flamegraph.pl, speedscope and friends.
+"""
+from collections import Counter
+import hashlib
+import os
+import re
+import sys
+import threading
+
+
+class StackSampler(object):
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._root = None
+        self._thread_id = None
+
+    def start(self):
+        # Only frames below the caller (the test run itself) are recorded
+        self._root = sys._getframe(1)
+        self._thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="rerunfailures-profiler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        return self.stacks
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None and frame is not self._root:
+                code = frame.f_code
+                filename = os.path.basename(code.co_filename)
+                stack.append("%s (%s:%d)" % (code.co_name, filename, code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+
+# Long enough to recognize the test, short enough for any file system
+MAX_NAME_PREFIX = 100
+
+
+def profile_filename(nodeid, attempt):
+    # The sanitized prefix is for humans, the hash keeps different nodeids apart
+    prefix = re.sub(r"[^\w.-]+", "_", nodeid)[:MAX_NAME_PREFIX]
+    digest = hashlib.sha1(nodeid.encode("utf-8")).hexdigest()[:10]
+    return "%s-%s.%d.collapsed" % (prefix, digest, attempt)
+
+
+def write_collapsed(path, stacks):
+    with open(path, "w") as f:
+        for stack, count in stacks.most_common():
+            f.write("%s %d\n" % (stack, count))
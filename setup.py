@@ -6,8 +6,9 @@ setup(name='pytest-rerunfailures',
       author='Leah Klearman',
       author_email='lklrmn@gmail.com',
       url='https://github.com/klrmn/pytest-rerunfailures',
-      install_requires=['pytest>=2.2.3'],
-      py_modules=['rerunfailures.plugin'],
+      python_requires='>=3.8',
+      install_requires=['pytest>=7.0'],
+      packages=['rerunfailures'],
       entry_points={'pytest11': ['pytest_rerunfailures = rerunfailures.plugin']},
       license='Mozilla Public License 2.0 (MPL 2.0)',
       keywords='py.test pytest qa',
@@ -22,5 +23,9 @@ setup(name='pytest-rerunfailures',
         'Topic :: Software Development :: Testing',
         'Topic :: Utilities',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.6',
-        'Programming Language :: Python :: 2.7'])
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12'])
@@ -1,3 +1,5 @@
+import socket
+
 import py, pytest
 
 
@@ -32,3 +34,41 @@ class TestConfig(object):
         assert len(failed) == 1
         out = failed[0].longrepr.reprcrash.message
         assert out == 'ERROR: --reruns incompatible with --looponfail'
+
+    def test_rerun_metrics_invalid_address(self, testdir):
+        file_test = testdir.makepyfile(self.passing_test)
+        result = testdir.runpytest('--reruns=3', '--rerun_metrics=notaport', file_test)
+        assert result.ret == pytest.ExitCode.USAGE_ERROR
+        result.stderr.fnmatch_lines(["*--rerun_metrics: expected [[]host:[]]port or unix:/path, got 'notaport'"])
+
+    def test_rerun_metrics_address_in_use(self, testdir):
+        file_test = testdir.makepyfile(self.passing_test)
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            sock.listen(1)
+            port = sock.getsockname()[1]
+            result = testdir.runpytest('--reruns=3', '--rerun_metrics=%d' % port, file_test)
+        assert result.ret == pytest.ExitCode.USAGE_ERROR
+        result.stderr.fnmatch_lines(["*--rerun_metrics: *Address already in use*"])
+
+    def test_rerun_metrics_keeps_non_socket_file(self, testdir):
+        file_test = testdir.makepyfile(self.passing_test)
+        testdir.makefile(".txt", metrics="keep me")
+        result = testdir.runpytest('--reruns=3', '--rerun_metrics=unix:metrics.txt', file_test)
+        assert result.ret == pytest.ExitCode.USAGE_ERROR
+        result.stderr.fnmatch_lines(["*--rerun_metrics: metrics.txt exists and is not a socket"])
+        assert testdir.tmpdir.join("metrics.txt").read() == "keep me"
+
+    def test_rerun_metrics_incompatible_with_xdist(self, testdir):
+        pytest.importorskip("xdist", reason="this test requires pytest-xdist")
+        file_test = testdir.makepyfile(self.passing_test)
+        result = testdir.runpytest('--reruns=3', '--rerun_metrics=unix:metrics.sock', '-n', '1', file_test)
+        assert result.ret == pytest.ExitCode.USAGE_ERROR
+        result.stderr.fnmatch_lines(["*--rerun_metrics is not supported with pytest-xdist (-n)"])
+
+    def test_rerun_after_incompatible_with_xdist(self, testdir):
+        pytest.importorskip("xdist", reason="this test requires pytest-xdist")
+        file_test = testdir.makepyfile(self.passing_test)
+        result = testdir.runpytest('--reruns=3', '--rerun_after', '-n', '1', file_test)
+        assert result.ret == pytest.ExitCode.USAGE_ERROR
+        result.stderr.fnmatch_lines(["*--rerun_after is not supported with pytest-xdist (-n)"])